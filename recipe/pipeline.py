@@ -1,24 +1,37 @@
-import os
+import hashlib
+import io
+import posixpath
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import cached_property
 from typing import List
 
 import dask
 import fsspec
+import numpy as np
+import pandas as pd
 import xarray as xr
+from numba import njit
 from numcodecs import Blosc
 from pangeo_forge.pipelines.base import AbstractPipeline
-from pangeo_forge.tasks.http import download
 from prefect import Flow, task, unmapped
 from prefect.environments import DaskKubernetesEnvironment
 from prefect.environments.storage import Docker
 
 # options
 name = "terraclimate"
-chunks = {"lat": 1024, "lon": 1024, "time": 12}
+# evenly tiles the (12, 4320, 8640) sources in ~50 MB float32 chunks
+chunks = {"lat": 720, "lon": 1440, "time": 12}
 # years = list(range(1958, 2020))
 years = list(range(1958, 1960))
 cache_location = f"gs://pangeo-forge-scratch/{name}-cache-2/"
 target_location = f"gs://pangeo-forge-scratch/{name}.zarr"
+source_url_pattern = "https://climate.northwestknowledge.net/TERRACLIMATE-DATA/TerraClimate_{var}_{year}.nc"
+block_size = 2 ** 22  # 4 MiB
+max_in_memory_size = 2 ** 30  # larger sources are staged in the cache
+max_concurrent_sources = 4  # per task, each may hold up to max_in_memory_size
+compressor = Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
 
 
 variables = [
@@ -40,6 +53,9 @@ variables = [
 
 rename_vars = {'PDSI': 'pdsi'}
 
+# ancillary variables that are not carried into the zarr store
+ignore_vars = ["crs"]
+
 mask_opts = {
     "PDSI": ("lt", 10),
     "aet": ("lt", 32767),
@@ -62,27 +78,61 @@ mask_opts = {
 }
 
 
+# blocks are masked concurrently on dask's threads, so the kernels release
+# the GIL instead of running their own (nested) numba thread pool
+@njit(nogil=True, cache=True)
+def _mask_ge(arr, val):
+    """in place, set values greater than or equal to val to NaN"""
+    flat = arr.reshape(-1)
+    for i in range(flat.size):
+        if flat[i] >= val:
+            flat[i] = np.nan
+
+
+@njit(nogil=True, cache=True)
+def _mask_eq(arr, val):
+    """in place, set values equal to val to NaN"""
+    flat = arr.reshape(-1)
+    for i in range(flat.size):
+        if flat[i] == val:
+            flat[i] = np.nan
+
+
+def _mask_block(arr, op, val):
+    """set values of a NumPy array that fail the mask test to NaN"""
+    # copy to a C-contiguous float32 array, so the masked write never touches
+    # the input block
+    arr = np.array(arr, dtype=np.float32, order="C")
+    if op == "lt":
+        _mask_ge(arr, val)
+    elif op == "neq":
+        _mask_eq(arr, val)
+    return arr
+
+
 def apply_mask(key, da):
     """helper function to mask DataArrays based on a threshold value"""
-    if mask_opts.get(key, None):
-        op, val = mask_opts[key]
-        if op == "lt":
-            da = da.where(da < val)
-        elif op == "neq":
-            da = da.where(da != val)
-    return da
+    if mask_opts.get(key, None) is None:
+        return da
+    op, val = mask_opts[key]
+    return xr.apply_ufunc(
+        _mask_block,
+        da,
+        kwargs={"op": op, "val": val},
+        dask="parallelized",
+        output_dtypes=[np.float32],
+        keep_attrs=True,
+    )
 
 
 def preproc(ds):
     """custom preprocessing function for terraclimate data"""
     rename = {}
 
-    station_influence = ds.get("station_influence", None)
-
-    if station_influence is not None:
-        ds = ds.drop_vars("station_influence")
+    var = [v for v in ds.data_vars if v != "station_influence"][0]
 
-    var = list(ds.data_vars)[0]
+    if "station_influence" in ds.data_vars:
+        rename["station_influence"] = f"{var}_station_influence"
 
     if var in rename_vars:
         rename[var] = rename_vars[var]
@@ -90,9 +140,6 @@ def preproc(ds):
     if "day" in ds.coords:
         rename["day"] = "time"
 
-    if station_influence is not None:
-        ds[f"{var}_station_influence"] = station_influence
-
     if rename:
         ds = ds.rename(rename)
 
@@ -117,6 +164,8 @@ def postproc(ds):
     for v in ds.data_vars.keys():
         with xr.set_options(keep_attrs=True):
             ds[v] = apply_mask(v, ds[v])
+        # the sources have far less than float32 precision, don't carry float64
+        ds[v] = ds[v].astype(np.float32, copy=False)
         for k in drop_encoding:
             ds[v].encoding.pop(k, None)
 
@@ -124,12 +173,24 @@ def postproc(ds):
 
 
 def get_encoding(ds):
-    compressor = Blosc()
-    encoding = {key: {"compressor": compressor} for key in ds.data_vars}
+    encoding = {key: {"compressor": compressor, "dtype": "float32"} for key in ds.data_vars}
     return encoding
 
 
-@task(max_retries=1, retry_delay=timedelta(seconds=1))
+def get_filesystem(url: str):
+    """authenticated filesystem for a cloud storage url"""
+    # fsspec caches filesystem instances, so tasks on the same worker share
+    # one instance (and its credentials and connection pool)
+    return fsspec.filesystem(url.split(':')[0], token='cloud')
+
+
+def cache_key(source_url: str) -> str:
+    """stable cache key for a source url"""
+    # builtin hash() is salted per process, use a stable digest so the cache
+    # is shared across workers and runs
+    return hashlib.blake2b(source_url.encode("utf-8"), digest_size=16).hexdigest()
+
+
 def download(source_url: str, cache_location: str) -> str:
     """
     Download a remote file to a cache.
@@ -142,67 +203,196 @@ def download(source_url: str, cache_location: str) -> str:
     Returns
     -------
     target_url : str
-        Path or url in the form of `{cache_location}/hash({source_url})`.
+        Path or url in the form of `{cache_location}/blake2b({source_url})`.
     """
-    fs = fsspec.get_filesystem_class(cache_location.split(':')[0])(token='cloud')
+    fs = get_filesystem(cache_location)
 
-    target_url = os.path.join(cache_location, str(hash(source_url)))
+    target_url = posixpath.join(cache_location, cache_key(source_url))
 
-    # there is probably a better way to do caching!
-    try:
-        fs.open(target_url)
+    if fs.exists(target_url):
         return target_url
-    except FileNotFoundError:
-        pass
 
-    with fsspec.open(source_url, mode="rb") as source:
-        with fs.open(target_url, mode="wb") as target:
-            target.write(source.read())
+    # stream in fixed-size blocks so the whole file is never held in memory
+    with fsspec.open(source_url, mode="rb", block_size=block_size) as source:
+        with fs.open(target_url, mode="wb", block_size=block_size) as target:
+            shutil.copyfileobj(source, target, length=block_size)
     return target_url
 
 
-@task(max_retries=1, retry_delay=timedelta(seconds=10))
-def nc2zarr(source_url: str, cache_location: str) -> str:
-    """convert netcdf data to zarr"""
-    fs = fsspec.get_filesystem_class(source_url.split(':')[0])(token='cloud')
-
-    target_url = source_url + ".zarr"
+def source_year(source_url: str) -> int:
+    """year of a terraclimate source file, parsed from its filename"""
+    return int(posixpath.basename(source_url).rsplit(".", 1)[0].rsplit("_", 1)[1])
 
-    with dask.config.set(scheduler="single-threaded"):
 
-        ds = (
-            xr.open_dataset(fs.open(source_url))
-            .pipe(preproc)
-            .pipe(postproc)
-            .load()
-            .chunk(chunks)
-        )
+def open_source(nc_file):
+    """open a terraclimate source file as a cleaned up, chunked dataset"""
+    # sources are always file-like objects (in-memory or fsspec), which the
+    # h5netcdf engine can read directly
+    ds = xr.open_dataset(nc_file, drop_variables=ignore_vars, chunks=chunks, engine="h5netcdf")
+    return ds.pipe(preproc).pipe(postproc)
 
-        mapper = fs.get_mapper(target_url)
-        ds.to_zarr(mapper, mode='w')
 
-    return target_url
+def _variable_template(var: str, years: List[int]) -> xr.Dataset:
+    """lazy dataset with the geometry of one variable over all years"""
+    with fsspec.open(source_url_pattern.format(var=var, year=years[0])) as f:
+        ds = open_source(f)
+        # only the metadata is written, the repeated time values are replaced
+        # by the real time coordinate in initialize_target
+        return xr.concat([ds] * len(years), dim="time", data_vars="minimal", coords="minimal")
 
 
 @task
-def combine_and_write(sources: List[str], target: str):
+def initialize_target(target: str, variables: List[str], years: List[int]) -> str:
     """
-    Combine one or more source datasets into a single `Xarray.Dataset`, then
-    write them to a Zarr store.
+    Create the target Zarr store with the full geometry of the dataset, but
+    without writing any data, so each source can be written to its own region.
     Parameters
     ----------
-    sources : list of str
-        Path or url to the source files.
     target : str
         Path or url to the target location of the Zarr store.
+    variables : list of str
+        Variables in the dataset.
+    years : list of int
+        Consecutive years in the dataset.
+    Returns
+    -------
+    target : str
+        Path or url to the initialized Zarr store.
+    """
+    templates = [_variable_template(var, years) for var in variables]
+
+    # sources are known to be one variable per file, so merge the variables
+    # directly rather than inferring the layout from the coordinates
+    template = xr.merge(
+        templates, compat="override", join="override", combine_attrs="override"
+    ).chunk(chunks)
+
+    # drop per-variable boilerplate that duplicates the target's global attrs;
+    # those come from the first variable only, so anything that differs is the
+    # only copy of that variable's provenance and is kept
+    for v in template.data_vars:
+        for k in ["history", "source", "institution"]:
+            if k in template[v].attrs and template[v].attrs[k] == template.attrs.get(k):
+                del template[v].attrs[k]
+
+    for dim, size in chunks.items():
+        if template.sizes[dim] % size:
+            raise ValueError(
+                f"chunks[{dim!r}] = {size} does not evenly divide {dim} ({template.sizes[dim]})"
+            )
+
+    # write the real time coordinate once here, the region writes leave it
+    # alone; the sources are monthly, so each year's time values are the first
+    # year's shifted by whole years
+    first_year = template.indexes["time"][: template.sizes["time"] // len(years)]
+    times = [first_year + pd.DateOffset(years=year - years[0]) for year in years]
+    template = template.assign_coords(time=np.concatenate([t.values for t in times]))
+
+    encoding = get_encoding(template)
+
+    mapper = get_filesystem(target).get_mapper(target)
+    template.to_zarr(mapper, mode="w", encoding=encoding, compute=False, consolidated=True)
+
+    return target
+
+
+def fetch_and_convert(source_url: str, target: str, years: List[int], cache_location: str) -> str:
+    """
+    Fetch a remote netcdf file and write it to its region of the target Zarr
+    store. Sources up to `max_in_memory_size` are read straight into memory,
+    larger ones are staged in the cache first.
+    Parameters
+    ----------
+    source_url : str
+        Path or url to the source file.
+    target : str
+        Path or url to the target Zarr store, created by `initialize_target`.
+    years : list of int
+        Consecutive years in the target store.
+    cache_location : str
+        Path or url to the cache location for large source files.
+    Returns
+    -------
+    target : str
+        Path or url to the target Zarr store.
     """
-    mappers = [fsspec.get_mapper(url) for url in sources]
-    ds_list = [xr.open_zarr(mapper) for mapper in mappers]
+    source_fs = fsspec.filesystem(source_url.split(':')[0])
+    size = source_fs.size(source_url)
+
+    if size is not None and size <= max_in_memory_size:
+        # fetch in a single request, without the file-object machinery
+        nc_file = io.BytesIO(source_fs.cat_file(source_url))
+    else:
+        nc_file = get_filesystem(cache_location).open(download(source_url, cache_location))
+
+    # twelve monthly time steps per source file
+    start = years.index(source_year(source_url)) * 12
+    region = {"time": slice(start, start + 12)}
+
+    with nc_file:
+
+        ds = open_source(nc_file)
+        # region writes may only contain variables along the region dimension,
+        # and the time coordinate was already written by initialize_target
+        ds = ds.drop_vars(["time"] + [v for v in ds.variables if "time" not in ds[v].dims])
+
+        mapper = get_filesystem(target).get_mapper(target)
+        # the target was consolidated when it was created, read its metadata
+        # from .zmetadata instead of every .zarray/.zattrs, and skip writing
+        # all-NaN chunks (e.g. over the oceans) altogether
+        write = ds.to_zarr(
+            mapper,
+            mode="r+",
+            region=region,
+            consolidated=True,
+            write_empty_chunks=False,
+            compute=False,
+        )
+
+        # decode, mask and compress chunks in parallel on the cpus the pod may
+        # use; the scheduler is passed to compute rather than set with
+        # dask.config.set, which is global and would race with the other
+        # sources process_variable writes concurrently
+        write.compute(scheduler="threads", num_workers=dask.system.CPU_COUNT)
+
+    return target
+
 
-    ds = xr.combine_by_coords(ds_list, combine_attrs='override')
+@task(max_retries=1, retry_delay=timedelta(seconds=10))
+def process_variable(var: str, target: str, years: List[int], cache_location: str) -> str:
+    """
+    Fetch every year of one variable and write them to their regions of the
+    target Zarr store.
+    Parameters
+    ----------
+    var : str
+        Variable to process.
+    target : str
+        Path or url to the target Zarr store, created by `initialize_target`.
+    years : list of int
+        Consecutive years in the target store.
+    cache_location : str
+        Path or url to the cache location for large source files.
+    Returns
+    -------
+    target : str
+        Path or url to the target Zarr store.
+    """
+    source_urls = [source_url_pattern.format(var=var, year=year) for year in years]
+
+    # one task per variable keeps the task count (and the scheduler and prefect
+    # overhead per task) low, the years are fanned out within the task so their
+    # downloads and zarr writes overlap; each year writes its own time region,
+    # so the writes never share a chunk
+    with ThreadPoolExecutor(max_workers=max_concurrent_sources) as executor:
+        list(
+            executor.map(
+                lambda url: fetch_and_convert(url, target, years, cache_location),
+                source_urls,
+            )
+        )
 
-    mapper = fsspec.get_mapper(target)
-    ds.to_zarr(mapper, mode="w", consolidated=True)
+    return target
 
 
 class TerraclimatePipeline(AbstractPipeline):
@@ -213,10 +403,8 @@ class TerraclimatePipeline(AbstractPipeline):
         self.variables = variables
         self.years = years
 
-    @property
+    @cached_property
     def sources(self):
-
-        source_url_pattern = "https://climate.northwestknowledge.net/TERRACLIMATE-DATA/TerraClimate_{var}_{year}.nc"
         source_urls = []
 
         for var in self.variables:
@@ -261,21 +449,17 @@ class TerraclimatePipeline(AbstractPipeline):
             raise ValueError("Zarr target requires self.targets be a length one list")
 
         with Flow(self.name, storage=self.storage, environment=self.environment) as _flow:
-            # download to cache
-            nc_sources = download.map(
-                self.sources,
+            # create an empty zarr archive covering all variables and years
+            target = initialize_target(target, self.variables, self.years)
+
+            # fetch netcdf data and write it straight into the zarr archive
+            process_variable.map(
+                self.variables,
+                target=unmapped(target),
+                years=unmapped(self.years),
                 cache_location=unmapped(self.cache_location),
             )
 
-            # convert cached netcdf data to zarr
-            cached_sources = nc2zarr.map(
-                nc_sources,
-                cache_location=unmapped(self.cache_location),
-            )
-
-            # combine all datasets into a single zarr archive
-            combine_and_write(cached_sources, target)
-
         return _flow
 
 